@@ -1,12 +1,16 @@
 from collections import OrderedDict
+import copy
+import inspect
 from math import log
 from typing import List
+from warnings import warn
 
 import torch
 from torch import Tensor
+import torch.fx
 import torch.nn as nn
 import torch.nn.functional as F
-from torchsummary import summary
+from torch.utils.checkpoint import checkpoint_sequential
 
 
 """"""""""""""""""""""""""""""""" Utilities """""""""""""""""""""""""""""""""
@@ -64,15 +68,33 @@ def conv2d(in_channels: int, out_channels: int, kernel_size: int,
                      padding=pad, bias=False)
 
 
+def upsample(inp: torch.Tensor, scale_factor: int):
+    return F.interpolate(inp, scale_factor=float(scale_factor),
+                         mode="bilinear", align_corners=True)
+
+
 class UpsampleBlock(nn.Module):
+    # Constants are specialized by torch.jit.script, pruning unused branches
+    __constants__ = ["is_channels_equal", "identity_shortcut",
+                     "upsample_shortcut", "stride"]
+
     def __init__(self, in_channels: int, out_channels: int, stride: int,
                  dropout_rate: float = 0.0):
         super().__init__()
         self.is_channels_equal = in_channels == out_channels
         self.stride = stride
+        # Branch choices as plain bools, so that they are constant when scripted
+        self.identity_shortcut = self.is_channels_equal and stride == 1
+        self.upsample_shortcut = self.is_channels_equal and stride == 2
 
         self.bn1 = batchnorm(in_channels)
-        self.conv1 = conv2d(in_channels, out_channels, 3, 1)
+        if stride == 1:
+            self.conv1 = conv2d(in_channels, out_channels, 3, 1)
+        else:
+            # Learned upsampling, saves the separate interpolation pass
+            self.conv1 = nn.ConvTranspose2d(in_channels, out_channels,
+                                            2 * stride, stride,
+                                            padding=stride // 2, bias=False)
         self.bn2 = batchnorm(out_channels)
         self.dropout = nn.Dropout2d(p=dropout_rate)
         self.conv2 = conv2d(out_channels, out_channels, 3, 1)
@@ -81,29 +103,23 @@ class UpsampleBlock(nn.Module):
         if not self.is_channels_equal:
             self.shortcut_conv = conv2d(in_channels, out_channels, 1, 1)
 
-    @staticmethod
-    def _upsample(inp: torch.Tensor, scale_factor: int):
-        return F.interpolate(inp, scale_factor=scale_factor, mode="bilinear",
-                             align_corners=True)
-
     def forward(self, x: torch.Tensor):
 
         # Main path
-        y = F.relu(self.bn1(x))  # BatchNorm + ReLU
-        y = self.conv1(y)  # First convolution
-        y = self._upsample(y, self.stride)  # Bilinear upsample
-        y = F.relu(self.bn2(y))  # BatchNorm + ReLU
+        y = F.relu_(self.bn1(x))  # BatchNorm + ReLU (in-place)
+        y = self.conv1(y)  # First (transposed) convolution
+        y = F.relu_(self.bn2(y))  # BatchNorm + ReLU (in-place)
         y = self.dropout(y)  # Dropout
         y = self.conv2(y)  # Second convolution
 
         # Residual path
-        if self.is_channels_equal and self.stride == 1:
+        if self.identity_shortcut:
             shortcut = x
-        elif self.is_channels_equal and self.stride == 2:
-            shortcut = self._upsample(x, self.stride)
+        elif self.upsample_shortcut:
+            shortcut = upsample(x, self.stride)
         else:
             shortcut = self.shortcut_conv(x)
-            shortcut = self._upsample(shortcut, self.stride)
+            shortcut = upsample(shortcut, self.stride)
 
         y = y + shortcut
 
@@ -111,11 +127,18 @@ class UpsampleBlock(nn.Module):
 
 
 class BasicBlock(nn.Module):
+    # Constants are specialized by torch.jit.script, pruning unused branches
+    __constants__ = ["is_channels_equal", "identity_shortcut",
+                     "pool_shortcut", "stride"]
+
     def __init__(self, in_channels: int, out_channels: int, stride: int,
                  dropout_rate: float = 0.0):
         super().__init__()
         self.is_channels_equal = in_channels == out_channels
         self.stride = stride
+        # Branch choices as plain bools, so that they are constant when scripted
+        self.identity_shortcut = self.is_channels_equal and stride == 1
+        self.pool_shortcut = self.is_channels_equal and stride == 2
 
         self.bn1 = batchnorm(in_channels)
         self.conv1 = conv2d(in_channels, out_channels, 3, stride)
@@ -126,22 +149,22 @@ class BasicBlock(nn.Module):
         # Shortcut needs conv if in_channels != out_channels
         if not self.is_channels_equal:
             self.shortcut_conv = conv2d(in_channels, out_channels, 1, stride)
-        if self.is_channels_equal and self.stride == 2:
+        if self.pool_shortcut:
             self.pool = nn.AvgPool2d(stride, stride)
 
     def forward(self, x: torch.Tensor):
 
         # Main path
-        y = F.relu(self.bn1(x))  # BatchNorm + ReLU
+        y = F.relu_(self.bn1(x))  # BatchNorm + ReLU (in-place)
         y = self.conv1(y)  # First convolution
-        y = F.relu(self.bn2(y))  # BatchNorm + ReLU
+        y = F.relu_(self.bn2(y))  # BatchNorm + ReLU (in-place)
         y = self.dropout(y)  # Dropout
         y = self.conv2(y)  # Second convolution
 
         # Residual path
-        if self.is_channels_equal and self.stride == 1:
+        if self.identity_shortcut:
             shortcut = x
-        elif self.is_channels_equal and self.stride == 2:
+        elif self.pool_shortcut:
             shortcut = self.pool(x)
         else:
             shortcut = self.shortcut_conv(x)
@@ -169,9 +192,16 @@ def upsample_group(in_channels: int, out_channels: int, n: int,
 
 class WideResNetAE(nn.Module):
     def __init__(self, inp_size: int, widen_factor: int = 1,
-                 dropout_rate: float = 0.0):
-        """Wide ResNet Autoencoder. Works for image sizes of 128, 256, and 512"""
+                 dropout_rate: float = 0.0, return_logits: bool = False,
+                 checkpointing: bool = False):
+        """Wide ResNet Autoencoder. Works for image sizes of 128, 256, and 512.
+        With return_logits, the final sigmoid is omitted (use a with-logits
+        loss and apply the sigmoid at inference). With checkpointing, the
+        activations of the conv and upsample groups are recomputed during
+        the backward pass instead of being stored (training only)"""
         super().__init__()
+        self.return_logits = return_logits
+        self.checkpointing = checkpointing
 
         assert (int(log(inp_size, 2)) - log(inp_size, 2)
                 == 0), "inp_size must be a power of 2"
@@ -232,22 +262,38 @@ class WideResNetAE(nn.Module):
 
     def forward(self, x: torch.Tensor):
 
-        z = self.enc(x)
-        y = self.dec(z)
+        if self.checkpointing and self.training:
+            y = self.checkpointed_forward(x)
+        else:
+            z = self.enc(x)
+            y = self.dec(z)
 
         # Final activation
-        y = torch.sigmoid(y)
+        if not self.return_logits:
+            y = torch.sigmoid(y)
 
         return y
 
+    @torch.jit.unused
+    def checkpointed_forward(self, x: torch.Tensor) -> torch.Tensor:
+        # The input does not require gradients, run the first convolution
+        # outside of the checkpoints so that all checkpointed segments
+        # receive gradients
+        z = self.enc[0](x)
+        z = checkpoint_sequential(self.enc[1:], len(self.enc) - 1, z)
+        y = checkpoint_sequential(self.dec, len(self.dec), z)
+        return y
+
 
 """"""""""""""""""""""""""""""""" UNet """""""""""""""""""""""""""""""""
 
 
 class UNet(nn.Module):
     """From https://github.com/mateuszbuda/brain-segmentation-pytorch/blob/master/unet.py"""
-    def __init__(self, in_channels=3, out_channels=1, init_features=32):
+    def __init__(self, in_channels=3, out_channels=1, init_features=32,
+                 return_logits=False):
         super(UNet, self).__init__()
+        self.return_logits = return_logits
 
         features = init_features
         self.encoder1 = UNet._block(in_channels, features, name="enc1")
@@ -302,7 +348,10 @@ class UNet(nn.Module):
         dec1 = self.upconv1(dec2)
         dec1 = torch.cat((dec1, enc1), dim=1)
         dec1 = self.decoder1(dec1)
-        return torch.sigmoid(self.conv(dec1))
+        y = self.conv(dec1)
+        if not self.return_logits:
+            y = torch.sigmoid(y)
+        return y
 
     @staticmethod
     def _block(in_channels, features, name):
@@ -497,7 +546,151 @@ class VAE(nn.Module):
         return [loss, recons_loss, kld_loss]
 
 
+""""""""""""""""""""""""""""""""" Inference """""""""""""""""""""""""""""""""
+
+
+class FrozenBatchNorm2d(nn.Module):
+    """Eval-mode BatchNorm2d as a single pointwise multiply-add. Unlike the
+    cuDNN BatchNorm kernel, it can be fused with the surrounding pointwise
+    ops (residual add, ReLU) by torch.fx / torch.jit / torch.compile"""
+    def __init__(self, bn: nn.BatchNorm2d):
+        super().__init__()
+        scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        self.register_buffer("scale", scale.detach().reshape(1, -1, 1, 1))
+        self.register_buffer("shift", shift.detach().reshape(1, -1, 1, 1))
+
+    def forward(self, x: torch.Tensor):
+        # addcmul promotes to the widest input type, keep fp16 under autocast
+        return torch.addcmul(self.shift.to(x.dtype), x, self.scale.to(x.dtype))
+
+
+def fuse_conv_bn_eval(conv: nn.Module, bn: nn.BatchNorm2d) -> nn.Module:
+    """Return a copy of conv (nn.Conv2d or nn.ConvTranspose2d) with the
+    (eval-mode) bn folded into its weight and bias"""
+    fused = copy.deepcopy(conv)
+    if fused.bias is None:
+        fused.bias = nn.Parameter(torch.zeros_like(bn.running_mean))
+
+    # Output channels are dim 0 for Conv2d and dim 1 for ConvTranspose2d
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+    if isinstance(conv, nn.ConvTranspose2d):
+        scale_shape = [1, -1, 1, 1]
+    else:
+        scale_shape = [-1, 1, 1, 1]
+    fused.weight = nn.Parameter(conv.weight * scale.reshape(scale_shape))
+    fused.bias = nn.Parameter(
+        (fused.bias - bn.running_mean) * scale + bn.bias)
+
+    return fused
+
+
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """Return an eval-mode copy of model where every BatchNorm that directly
+    follows a convolution is folded into that convolution.
+
+    The pre-activation BatchNorms of the Wide ResNet blocks (bn1) are preceded
+    by the residual addition and cannot be folded, they are replaced by a
+    FrozenBatchNorm2d instead, so that the residual add of the previous
+    block, bn1, and the ReLU form one fusible pointwise chain. bn2 directly
+    follows conv1.
+    """
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        for m in list(model.modules()):
+            if isinstance(m, (BasicBlock, UpsampleBlock)):
+                m.bn1 = FrozenBatchNorm2d(m.bn1)
+                m.conv1 = fuse_conv_bn_eval(m.conv1, m.bn2)
+                m.bn2 = nn.Identity()
+            elif isinstance(m, nn.Sequential):
+                names = list(m._modules.keys())
+                for conv_name, bn_name in zip(names[:-1], names[1:]):
+                    conv = m._modules[conv_name]
+                    bn = m._modules[bn_name]
+                    if (isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d))
+                            and isinstance(bn, nn.BatchNorm2d)):
+                        m._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                        m._modules[bn_name] = nn.Identity()
+    return model
+
+
+def specialize(model: nn.Module, script: bool = True) -> nn.Module:
+    """Return an eval-mode torch.fx GraphModule of model with BatchNorms
+    folded into the convolutions (see fuse_conv_bn).
+
+    Tracing resolves all static Python branches (channel and stride checks,
+    return_logits, ...), and the Identity placeholders of the folded
+    BatchNorms and the (eval-mode no-op) Dropouts are removed from the graph.
+    With script, the GraphModule is scripted and frozen, so that the
+    TorchScript fuser fuses the remaining pointwise chains (residual add,
+    FrozenBatchNorm2d, ReLU) into single kernels. Disable it if the result
+    is passed to torch.compile. The result is for inference only,
+    re-specialize after training.
+    """
+    model = fuse_conv_bn(model)
+    graph_module = torch.fx.symbolic_trace(model)
+
+    modules = dict(graph_module.named_modules())
+    for node in list(graph_module.graph.nodes):
+        if node.op == "call_module" and isinstance(
+                modules[node.target], (nn.Identity, nn.Dropout, nn.Dropout2d)):
+            node.replace_all_uses_with(node.args[0])
+            graph_module.graph.erase_node(node)
+    graph_module.graph.lint()
+    graph_module.recompile()
+    graph_module.eval()
+
+    if script:
+        return torch.jit.freeze(torch.jit.script(graph_module))
+    return graph_module
+
+
+def quantize_int8(model: nn.Module, calibrate, example_inputs=None) -> nn.Module:
+    """Post-training static INT8 quantization with torch.fx (CPU, fbgemm).
+
+    Conv-BN-ReLU patterns are fused during preparation. Both inputs of the
+    UNet skip concatenations are observed, so torch.cat runs on quantized
+    tensors as well.
+
+    Args:
+        model (nn.Module): Float model, must not be scripted or compiled
+        calibrate (callable): Runs representative inputs through the
+                              prepared model that is passed to it
+        example_inputs (tuple): Inputs to the model, required by prepare_fx
+                                from PyTorch 1.13 on
+    """
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import convert_fx, prepare_fx
+
+    model = copy.deepcopy(model).eval()
+    qconfig_dict = {"": get_default_qconfig("fbgemm")}
+    if "example_inputs" in inspect.signature(prepare_fx).parameters:
+        if example_inputs is None:
+            raise ValueError("prepare_fx of this PyTorch version requires "
+                             "example_inputs")
+        prepared = prepare_fx(model, qconfig_dict,
+                              example_inputs=example_inputs)
+    else:
+        prepared = prepare_fx(model, qconfig_dict)
+    with torch.no_grad():
+        calibrate(prepared)
+    return convert_fx(prepared)
+
+
+def compile_model(model: nn.Module, mode: str = "reduce-overhead") -> nn.Module:
+    """Compile model with torch.compile (PyTorch >= 2.0). "reduce-overhead"
+    captures the forward pass as CUDA graph, removing the launch overhead of
+    the many small Conv-BN-ReLU kernels. Input shapes should stay fixed to
+    avoid recompilation."""
+    if not hasattr(torch, "compile"):
+        warn("torch.compile requires PyTorch >= 2.0, using the eager model")
+        return model
+    return torch.compile(model, mode=mode)
+
+
 if __name__ == '__main__':
+    from torchsummary import summary
+
     device = "cpu"
     # size = 256
     # model = UNet(in_channels=1, out_channels=1, init_features=32).to(device)
@@ -5,14 +5,16 @@ import os
 import torch
 from tqdm import tqdm
 
+from uas_mood.models.models import compile_model, quantize_int8, specialize
 from uas_mood.train_patch_interpolation import LitModel
 from uas_mood.utils.data_utils import process_scan, save_nii, write_txt
 from uas_mood.utils.evaluation import samplewise_score
 
 
-def predict_folder(input_dir, output_dir, mode, model_ckpt, verbose):
-    # Select device
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+def predict_folder(input_dir, output_dir, mode, model_ckpt, verbose,
+                   int8=False, num_calib=4, compile_net=False):
+    # Select device, quantized models only run on the CPU
+    device = "cuda" if torch.cuda.is_available() and not int8 else "cpu"
 
     # Read all input files to a list
     if input_dir[-1] != "/":
@@ -22,6 +24,34 @@ def predict_folder(input_dir, output_dir, mode, model_ckpt, verbose):
 
     # Load model
     model = LitModel.load_from_checkpoint(model_ckpt).to(device)
+    model.eval()
+
+    if int8:
+        # torch.fx cannot trace scripted or compiled networks
+        if (getattr(model.args, "jit", False)
+                or getattr(model.args, "compile", False)):
+            raise ValueError("--int8 does not work with checkpoints trained "
+                             "with --jit or --compile")
+
+        # Calibrate the activation ranges on the first input volumes
+        def calibrate(net):
+            model.net = net
+            for f in files[:num_calib]:
+                x = torch.from_numpy(process_scan(f, model.args.img_size, False))
+                model.predict_volume(x, batch_size=8)
+
+        size = model.args.img_size
+        example_inputs = (
+            torch.randn(8, model.args.slices_on_forward, size, size),)
+        model.net = quantize_int8(model.net, calibrate, example_inputs)
+    elif not (getattr(model.args, "jit", False)
+              or getattr(model.args, "compile", False)):
+        # Fold BatchNorms into the preceding convolutions, trace away all
+        # static branches and script the result for inference (unless it is
+        # compiled). Scripted or compiled networks cannot be traced
+        model.net = specialize(model.net, script=not compile_net)
+        if compile_net:
+            model.net = compile_model(model.net)
 
     if verbose:
         print("Model hyperparameters")
@@ -65,6 +95,12 @@ if __name__ == "__main__":
                         help="can be either 'pixel' or 'sample'.")
     parser.add_argument("--model_ckpt", type=str, required=True)
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--int8", action="store_true",
+                        help="Run the model INT8 quantized on the CPU")
+    parser.add_argument("--num_calib", type=int, default=4,
+                        help="Number of volumes to calibrate INT8 with")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the network with torch.compile")
     args = parser.parse_args()
 
     input_dir = args.input_dir
@@ -72,8 +108,13 @@ if __name__ == "__main__":
     mode = args.mode
     model_ckpt = args.model_ckpt
     verbose = args.verbose
+    int8 = args.int8
+    num_calib = args.num_calib
+    compile_net = args.compile
 
     if not isinstance(mode, list):
         mode = list(mode)
 
-    predict_folder(input_dir, output_dir, mode, model_ckpt, verbose)
+    predict_folder(input_dir, output_dir, mode, model_ckpt, verbose,
+                   int8=int8, num_calib=num_calib,
+                   compile_net=compile_net)
@@ -49,32 +49,65 @@ class LitModel(pl.LightningModule):
         self.save_hyperparameters()
         self.args = self.hparams.args
 
+        # Checkpointed segments are torch.jit.unused and cannot be scripted
+        if (getattr(self.args, "grad_checkpointing", False)
+                and getattr(self.args, "jit", False)):
+            raise ValueError("--grad_checkpointing does not work with --jit")
+
         # Network
         if self.args.model == "UNet":
             self.print_("Using UNet")
             self.net = models.UNet(in_channels=1, out_channels=1,
-                                init_features=self.args.model_width)
+                                init_features=self.args.model_width,
+                                return_logits=True)
             self.net.apply(models.weights_init_relu)
         else:
             self.print_("Using ResNet")
+            grad_checkpointing = getattr(self.args, "grad_checkpointing", False)
             self.net = models.WideResNetAE(inp_size=args.img_size,
-                                           widen_factor=self.args.model_width)
+                                           widen_factor=self.args.model_width,
+                                           return_logits=True,
+                                           checkpointing=grad_checkpointing)
+
+        # NHWC memory format lets cuDNN select tensor core kernels
+        if getattr(self.args, "channels_last", False):
+            self.net = self.net.to(memory_format=torch.channels_last)
+
+        # Script the network so that pointwise ops (BatchNorm, ReLU, add)
+        # can be fused into single kernels
+        if getattr(self.args, "jit", False):
+            self.net = torch.jit.script(self.net)
+        if getattr(self.args, "compile", False):
+            self.net = models.compile_model(self.net)
 
         # Example input array needed to log the graph in tensorboard
         input_size = (1, self.args.img_size, self.args.img_size)
         self.example_input_array = torch.randn(
             [5, *input_size])
 
-        # Init Loss function
-        self.loss_fn = torch.nn.BCELoss()
+        # Init Loss function, the network returns logits during training
+        self.loss_fn = torch.nn.BCEWithLogitsLoss()
 
         if self.logger:
             self.logger.log_hyperparams(self.args)
 
-    def forward(self, x):
+    def forward_logits(self, x):
+        if getattr(self.args, "channels_last", False):
+            x = x.contiguous(memory_format=torch.channels_last)
         y = self.net(x)
         return y
 
+    def forward(self, x):
+        """Returns the anomaly map"""
+        return torch.sigmoid(self.forward_logits(x))
+
+    @staticmethod
+    def compute_loss(pred, target):
+        """BCE on probabilities (e.g. on aggregated predictions)"""
+        # BCE is not autocast-safe, always compute it in full precision
+        with torch.cuda.amp.autocast(enabled=False):
+            return F.binary_cross_entropy(pred.float(), target.float())
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(
             self.parameters(), lr=self.args.lr, weight_decay=0.5 * 0.0005)
@@ -138,10 +171,10 @@ class LitModel(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         x, y = batch
-        pred = self(x)
+        logits = self.forward_logits(x)
 
         # Compute loss
-        loss = self.loss_fn(pred, y)
+        loss = self.loss_fn(logits, y)
 
         self.log("loss", loss.cpu(), on_step=True)
 
@@ -165,7 +198,7 @@ class LitModel(pl.LightningModule):
         score = pred.mean(dim=(1, 2, 3))
 
         # Compute loss
-        loss = self.loss_fn(score, y.float())
+        loss = self.compute_loss(score, y)
 
         return {
             "inp": x.cpu(),
@@ -321,6 +354,10 @@ def train(args, trainer, train_files):
                            num_workers=0, shuffle=True)
 
     # Train
+    if args.grad_checkpointing:
+        warn("Gradient checkpointing recomputes the forward pass, BatchNorm "
+             "running statistics are updated twice per step and are skewed "
+             "towards the current batch")
     model.start_time = time()
     utils.printer("Start training", args.verbose)
     trainer.fit(model, trainloader, valloader)
@@ -388,6 +425,16 @@ if __name__ == '__main__':
     parser.add_argument("--gpus", type=int, default=1)
     parser.add_argument("--precision", type=int, default=32)
     parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--channels_last", action="store_true",
+                        help="Use the NHWC memory format")
+    parser.add_argument("--grad_checkpointing", action="store_true",
+                        help="Trade compute for memory in the Wide ResNet. "
+                        "Not compatible with --jit. BatchNorm running stats "
+                        "are updated twice per step")
+    parser.add_argument("--jit", action="store_true",
+                        help="Compile the network with torch.jit.script")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the network with torch.compile")
     # Logging params
     parser.add_argument("--log_dir", type=str,
                         default=f"{os.path.dirname(os.path.abspath(__file__))}/logs/cxr14")
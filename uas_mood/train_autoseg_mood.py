@@ -67,16 +67,35 @@ class LitModel(pl.LightningModule):
         self.save_hyperparameters()
         self.args = self.hparams.args
 
+        # Checkpointed segments are torch.jit.unused and cannot be scripted
+        if (getattr(self.args, "grad_checkpointing", False)
+                and getattr(self.args, "jit", False)):
+            raise ValueError("--grad_checkpointing does not work with --jit")
+
         # Network
         if self.args.model == "unet":
             self.print_("Using UNet")
             self.net = models.UNet(in_channels=self.args.slices_on_forward,
-                                 out_channels=1, init_features=args.model_width)
+                                 out_channels=1, init_features=args.model_width,
+                                 return_logits=True)
             self.net.apply(models.weights_init_relu)
         else:
             self.print_("Using Wide ResNet")
+            grad_checkpointing = getattr(self.args, "grad_checkpointing", False)
             self.net = models.WideResNetAE(inp_size=args.img_size,
-                                           widen_factor=4)
+                                           widen_factor=4, return_logits=True,
+                                           checkpointing=grad_checkpointing)
+
+        # NHWC memory format lets cuDNN select tensor core kernels
+        if getattr(self.args, "channels_last", False):
+            self.net = self.net.to(memory_format=torch.channels_last)
+
+        # Script the network so that pointwise ops (BatchNorm, ReLU, add)
+        # can be fused into single kernels
+        if getattr(self.args, "jit", False):
+            self.net = torch.jit.script(self.net)
+        if getattr(self.args, "compile", False):
+            self.net = models.compile_model(self.net)
 
         # Example input array needed to log the graph in tensorboard
         # input_size = (1, args.img_size, args.img_size)
@@ -84,16 +103,29 @@ class LitModel(pl.LightningModule):
         self.example_input_array = torch.randn(
             [5, *input_size])
 
-        # Init Loss function
-        self.loss_fn = torch.nn.BCELoss()
+        # Init Loss function, the network returns logits during training
+        self.loss_fn = torch.nn.BCEWithLogitsLoss()
 
         if self.logger:
             self.logger.log_hyperparams(self.args)
 
-    def forward(self, x):
+    def forward_logits(self, x):
+        if getattr(self.args, "channels_last", False):
+            x = x.contiguous(memory_format=torch.channels_last)
         y = self.net(x)
         return y
 
+    def forward(self, x):
+        """Returns the anomaly map"""
+        return torch.sigmoid(self.forward_logits(x))
+
+    @staticmethod
+    def compute_loss(pred, target):
+        """BCE on probabilities (e.g. on aggregated predictions)"""
+        # BCE is not autocast-safe, always compute it in full precision
+        with torch.cuda.amp.autocast(enabled=False):
+            return F.binary_cross_entropy(pred.float(), target.float())
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(
             self.parameters(), lr=self.args.lr, weight_decay=0.5 * 0.0005)
@@ -158,10 +190,10 @@ class LitModel(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         x, y = batch
-        pred = self(x)
+        logits = self.forward_logits(x)
 
         # Compute loss
-        loss = self.loss_fn(pred, y)
+        loss = self.loss_fn(logits, y)
 
         self.log("loss", loss.cpu(), on_step=True)
 
@@ -180,10 +212,11 @@ class LitModel(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
-        pred = self(x)
+        logits = self.forward_logits(x)
+        pred = torch.sigmoid(logits)
 
         # Compute loss
-        loss = self.loss_fn(pred, y)
+        loss = self.loss_fn(logits, y)
 
         return {
             "inp": x[:, self.args.slices_on_forward // 2].unsqueeze(1).cpu(),
@@ -250,7 +283,7 @@ class LitModel(pl.LightningModule):
         pred = self.predict_volume(x)
 
         # Compute loss
-        loss = self.loss_fn(pred, y.float())
+        loss = self.compute_loss(pred, y)
 
         return {
             "inp": x.cpu(),
@@ -353,6 +386,11 @@ class LitModel(pl.LightningModule):
         if batch_size is None:
             batch_size = x.shape[0]
 
+        # Run the forward passes in half precision if trained with AMP
+        with torch.cuda.amp.autocast(enabled=self.args.precision == 16):
+            return self._predict_volume(x, batch_size)
+
+    def _predict_volume(self, x, batch_size):
         p = self.args.slices_on_forward // 2
 
         # ----- AXIAL -----
@@ -430,19 +468,27 @@ def train(args, trainer, train_files):
     # Create Datasets and Dataloaders
     train_ds = PatchSwapDataset(training_files, args.img_size, data=args.data,
                                 slices_on_forward=args.slices_on_forward,
-                                num_anomalies=args.num_anomalies)
+                                num_anomalies=args.num_anomalies,
+                                shared_memory=args.shared_memory)
     trainloader = DataLoader(train_ds, batch_size=args.batch_size,
-                             num_workers=args.num_workers, shuffle=True)
+                             num_workers=args.num_workers, shuffle=True,
+                             pin_memory=True)
     val_ds = PatchSwapDataset(val_files, args.img_size, data=args.data,
                               slices_on_forward=args.slices_on_forward,
-                              num_anomalies=args.num_anomalies)
+                              num_anomalies=args.num_anomalies,
+                              shared_memory=args.shared_memory)
     valloader = DataLoader(val_ds, batch_size=args.batch_size,
-                           num_workers=args.num_workers, shuffle=True)
+                           num_workers=args.num_workers, shuffle=True,
+                           pin_memory=True)
 
     utils.printer(
         f"Finished loading training data in {time() - t_start:.2f}s", args.verbose)
 
     # Train
+    if args.grad_checkpointing:
+        warn("Gradient checkpointing recomputes the forward pass, BatchNorm "
+             "running statistics are updated twice per step and are skewed "
+             "towards the current batch")
     model.start_time = time()
     utils.printer("Start training", args.verbose)
     trainer.fit(model, trainloader, valloader)
@@ -476,6 +522,12 @@ def test(args, trainer, test_files, model=None):
     ds = TestDataset(test_files, args.img_size)
     print(f"Finished loading data in {time() - t_start:.2f}s")
 
+    # Fold BatchNorms into the preceding convolutions, trace away all static
+    # branches and script the result for inference (not possible for
+    # scripted or compiled nets)
+    if not (args.jit or args.compile):
+        model.net = models.specialize(model.net)
+
     # Test
     print("Testing model")
     trainer.test(model, ds)
@@ -495,6 +547,10 @@ if __name__ == '__main__':
     parser.add_argument("--val_fraction", type=float, default=0.05)
     parser.add_argument("--no_load_to_ram", dest="load_to_ram",
                         action="store_false")
+    parser.add_argument("--shared_memory", action="store_true",
+                        help="Load the training scans into /dev/shm instead "
+                        "of private memory. /dev/shm must fit the whole "
+                        "training set")
     # Data params
     parser.add_argument("--data", type=str, default="brain",
                         choices=["brain", "abdom"])
@@ -505,6 +561,16 @@ if __name__ == '__main__':
     parser.add_argument("--gpus", type=int, default=1)
     parser.add_argument("--precision", type=int, default=32)
     parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--channels_last", action="store_true",
+                        help="Use the NHWC memory format")
+    parser.add_argument("--grad_checkpointing", action="store_true",
+                        help="Trade compute for memory in the Wide ResNet. "
+                        "Not compatible with --jit. BatchNorm running stats "
+                        "are updated twice per step")
+    parser.add_argument("--jit", action="store_true",
+                        help="Compile the network with torch.jit.script")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the network with torch.compile")
     # Logging params
     parser.add_argument("--log_dir", type=str,
                         default=f"{os.path.dirname(os.path.abspath(__file__))}/logs/")
@@ -100,16 +100,14 @@ def create_ellipse(center, size, img_size):
     return mask
 
 
-def create_polygon(center, size, img_size, n_vertices, order):
-    """Create a random polygon with n_vertices.
+def sample_polygon_points(n_vertices, order):
+    """Sample the outline of a random polygon with n_vertices around the
+    origin.
 
     Args:
     :param int n_vertices: Number of vertices
-    :param tuple(int, int) img_shape: (width, height)
-    :param tuple(int, int) center: center coordinates (x, y)
-    :param tuple(int, int) scale: scaling factors (x, y)
     :param int order: Select 1 for streight lines, 3 for cubic splines
-    :returns np.ndarray poly_mask: Mask of img_size with the polygon inside
+    :returns np.ndarray poly_points: Outline points, shape [101, 2]
     """
     # Sample random radius
     r = np.random.uniform(0.1, 0.5, n_vertices)
@@ -130,9 +128,28 @@ def create_polygon(center, size, img_size, n_vertices, order):
     poly_points = interpolate.splev(unew, tck)
     poly_points = np.array(poly_points).T
 
-    # Scale and shift
-    poly_points *= size
-    poly_points += center
+    return poly_points
+
+
+def create_polygon(center, size, img_size, n_vertices, order,
+                   poly_points=None):
+    """Create a random polygon with n_vertices.
+
+    Args:
+    :param int n_vertices: Number of vertices
+    :param tuple(int, int) img_shape: (width, height)
+    :param tuple(int, int) center: center coordinates (x, y)
+    :param tuple(int, int) scale: scaling factors (x, y)
+    :param int order: Select 1 for streight lines, 3 for cubic splines
+    :param np.ndarray poly_points: Optional, pre-sampled polygon outline
+                                   from sample_polygon_points
+    :returns np.ndarray poly_mask: Mask of img_size with the polygon inside
+    """
+    if poly_points is None:
+        poly_points = sample_polygon_points(n_vertices, order)
+
+    # Scale and shift (not in-place, poly_points may come from a pool)
+    poly_points = poly_points * size + center
 
     # Render polygon to image mask
     img = Image.new("L", size=img_size, color=0)
@@ -143,7 +160,8 @@ def create_polygon(center, size, img_size, n_vertices, order):
     return poly_mask
 
 
-def sample_patch(img, size_range, data, patch_type, poly_type, n_vertices):
+def sample_patch(img, size_range, data, patch_type, poly_type, n_vertices,
+                 polygon_pool=None):
     """Sample a patch of random size at a random location
 
     :param np.ndarray img: Original image to create the patch for, shape [c, w, h]
@@ -152,6 +170,9 @@ def sample_patch(img, size_range, data, patch_type, poly_type, n_vertices):
     :param str patch_type: "rectangle", "ellipse" or "polygon"
     :param str poly_type: "linear" or "cubic"
     :param int n_vertices: Only relevant for "polygon"
+    :param np.ndarray polygon_pool: Optional, only relevant for "polygon".
+                                    Pre-sampled polygon outlines to draw from,
+                                    shape [n, 101, 2]
     :return np.ndarray mask: mask with same size as img with sampled patch
     """
     # Sample location
@@ -174,12 +195,17 @@ def sample_patch(img, size_range, data, patch_type, poly_type, n_vertices):
             img_size=img_size,
         )
     elif patch_type == "polygon":
+        if polygon_pool is not None:
+            poly_points = polygon_pool[np.random.randint(len(polygon_pool))]
+        else:
+            poly_points = None
         mask = create_polygon(
             center=center,
             size=size,
             img_size=img_size,
             order=1 if poly_type == "linear" else 3,
             n_vertices=n_vertices,
+            poly_points=poly_points,
         )
     elif patch_type == "ellipse":
         mask = create_ellipse(
@@ -215,7 +241,8 @@ def sample_complete_mask(n_patches, blur_prob, img, **kwargs):
 
 def patch_exchange(img1: np.ndarray, img2: np.ndarray, mask: np.ndarray):
     """Create a sample where one patch is switched from another sample
-    with a random interpolation factor
+    with a random interpolation factor. The inputs are not modified, the
+    results are written to new arrays.
 
     Args:
     :param np.ndarray img1: shape [w, h]
@@ -223,25 +250,21 @@ def patch_exchange(img1: np.ndarray, img2: np.ndarray, mask: np.ndarray):
     :param np.ndarray mask: shape [w, h], mask indicating the pixels to swap
     :param float tolerance: tolerance for creating valid label
     """
-    zero_mask = 1 - mask
-
     # Sample interpolation factor alpha
     alpha = random.uniform(0.05, 0.95)
     # alpha = 0.95
 
     # Target pixel value is also alpha
     patch = mask * alpha
-    patch_inv = mask - patch
-
-    # Interpolate between patches
-    patch_set = patch * img2 + patch_inv * img1
-    patchex = img1 * zero_mask + patch_set
 
-    valid_label = (
-        mask * img1)[..., None] != (mask * img2)[..., None]
-    valid_label = np.any(valid_label, axis=-1)
+    # Interpolate between patches, img1 * (1 - patch) + img2 * patch,
+    # computed in-place in a single float32 buffer
+    patchex = np.subtract(img2, img1, dtype=np.float32)
+    patchex *= patch
+    patchex += img1
 
-    label = valid_label * patch
+    # Only label pixels that actually differ between the images
+    label = patch * (img1 != img2)
 
     return patchex, label
 
@@ -249,9 +249,9 @@ def load_segmentation(path: str, size: int = None, bin_threshold: float = 0.4):
     # Load
     segmentation, _ = load_nii(path, size=size, primary_axis=2, dtype='float32')
 
-    # Binarize
+    # Binarize, uint8 is sufficient for binary masks
     segmentation = np.where(
-        segmentation > bin_threshold, 1, 0).astype(np.short)
+        segmentation > bin_threshold, 1, 0).astype(np.uint8)
 
     return segmentation
 
@@ -1,8 +1,11 @@
 from abc import abstractclassmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from glob import glob
-from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import os
 import random
+import shutil
 from typing import List
 from warnings import warn
 
@@ -11,7 +14,11 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
-from uas_mood.utils.artificial_anomalies import patch_exchange, sample_complete_mask
+from uas_mood.utils.artificial_anomalies import (
+    patch_exchange,
+    sample_complete_mask,
+    sample_polygon_points,
+)
 from uas_mood.utils.data_utils import (
     load_image,
     load_segmentation,
@@ -46,36 +53,109 @@ def plot(images, f=None):
 class PreloadDataset(Dataset):
     def __init__(self):
         super().__init__()
+        self.shm = None
+        self.shm_owner_pid = None
 
     @staticmethod
     @abstractclassmethod
-    def load_batch():
+    def load_file():
         pass
 
     def load_files_to_ram(self, paths, img_size):
         # Set number of cpus used
         num_cpus = os.cpu_count() - 4
 
-        # Split list into batches
-        batches = [list(p) for p in np.array_split(
-            paths, num_cpus) if len(p) > 0]
+        # Start multiprocessing, small chunks balance the load between workers
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            res = list(executor.map(
+                partial(self.load_file, img_size=img_size),
+                paths,
+                chunksize=4
+            ))
 
-        # Start multiprocessing
-        with Pool(processes=num_cpus) as pool:
-            res = pool.starmap(
-                self.load_batch,
-                zip(batches, [img_size for _ in batches])
-            )
+        return res
+
+    def load_files_to_array(self, paths, img_size, shape, dtype):
+        """Like load_files_to_ram, but the results are written to one array
+        of shape as they arrive, so that the list of all loaded files is
+        never held in memory next to the array"""
+        # Set number of cpus used
+        num_cpus = os.cpu_count() - 4
+
+        res = np.empty(shape, dtype=dtype)
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            for i, r in enumerate(executor.map(
+                partial(self.load_file, img_size=img_size),
+                paths,
+                chunksize=4
+            )):
+                res[i] = r
 
         return res
 
+    def load_files_to_shared_memory(self, paths, img_size, shape, dtype):
+        """Like load_files_to_ram, but the workers write their results
+        directly into one shared array of shape, instead of pickling them
+        back to the main process. Requires the load_file_to_shared_memory
+        method.
+
+        The array lives in POSIX shared memory (/dev/shm on Linux), which
+        needs to be large enough to hold all of it. /dev/shm is a tmpfs
+        limited to half of the RAM by default and to 64 MB in Docker
+        (increase it with --shm-size)."""
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        # Writing beyond the capacity of /dev/shm crashes with SIGBUS
+        if os.path.isdir("/dev/shm"):
+            free = shutil.disk_usage("/dev/shm").free
+            if size > free:
+                raise RuntimeError(
+                    f"Loading to shared memory needs {size / 1e9:.2f} GB, but "
+                    f"only {free / 1e9:.2f} GB are free in /dev/shm. Increase "
+                    "its size or load to private memory instead")
+
+        # Set number of cpus used
+        num_cpus = os.cpu_count() - 4
+
+        # Allocate the shared array. The name is kept until the dataset in
+        # this process is deleted, so that spawned processes can attach
+        self.shm = SharedMemory(create=True, size=size)
+        self.shm_owner_pid = os.getpid()
+        self.shm_shape = shape
+        self.shm_dtype = dtype
+
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            list(executor.map(
+                partial(self.load_file_to_shared_memory, img_size=img_size,
+                        shm_name=self.shm.name, shape=shape, dtype=dtype),
+                range(len(paths)),
+                paths,
+                chunksize=4
+            ))
+
+        return self.shared_array()
+
+    def shared_array(self):
+        return np.ndarray(self.shm_shape, dtype=self.shm_dtype,
+                          buffer=self.shm.buf)
+
+    def __del__(self):
+        shm = getattr(self, "shm", None)
+        if shm is None:
+            return
+        # Only the creating process removes the name, forked or spawned
+        # copies just detach
+        if self.shm_owner_pid == os.getpid():
+            shm.unlink()
+        shm.close()
+
 
 class TestDataset(PreloadDataset):
     def __init__(self, files, img_size):
         super().__init__()
         res = self.load_files_to_ram(files, img_size)
-        samples = [s for t in res for s in t["samples"]]
-        segmentations = [s for t in res for s in t["segmentations"]]
+        samples = [r["sample"] for r in res]
+        segmentations = [r["segmentation"] for r in res]
 
         self.samples = [(s[0], torch.from_numpy(s[1])) for s in samples]
         self.segmentations = [(s[0], torch.from_numpy(s[1]))
@@ -85,21 +165,16 @@ class TestDataset(PreloadDataset):
         return len(self.samples)
 
     @staticmethod
-    def load_batch(files, img_size):
-        samples = []
-        segmentations = []
-
-        for f in files:
-            # Samples are shape [width, height, slices]
-            samples.append((f, process_scan(f, img_size, equalize_hist=False)))
-            # Load segmentation, is in folder test_label/pixel instead of test
-            f_seg = f.replace("test", "test_label/pixel")
-            segmentations.append(
-                (f_seg, load_segmentation(f_seg, img_size)))
+    def load_file(f, img_size):
+        # Samples are shape [width, height, slices]
+        sample = (f, process_scan(f, img_size, equalize_hist=False))
+        # Load segmentation, is in folder test_label/pixel instead of test
+        f_seg = f.replace("test", "test_label/pixel")
+        segmentation = (f_seg, load_segmentation(f_seg, img_size))
 
         return {
-            "samples": samples,
-            "segmentations": segmentations
+            "sample": sample,
+            "segmentation": segmentation
         }
 
     def __getitem__(self, idx):
@@ -107,54 +182,134 @@ class TestDataset(PreloadDataset):
 
 
 class PatchSwapDataset(PreloadDataset):
-    def __init__(self, files, img_size, data, slices_on_forward, num_anomalies=1):
+    def __init__(self, files, img_size, data, slices_on_forward, num_anomalies=1,
+                 polygon_pool_size=10000, shared_memory=False):
+        """With shared_memory, the scans are loaded into POSIX shared memory
+        (see PreloadDataset.load_files_to_shared_memory) instead of private
+        memory, which avoids pickling every scan back to the main process"""
         super().__init__()
         assert data in ["brain", "abdom"]
         assert slices_on_forward in [1, 3], "PatchSwapDataset only works with slices_on_forward 1 or 3"
 
         self.num_anomalies = num_anomalies
 
-        res = self.load_files_to_ram(files, img_size)
-        samples = [s for r in res for s in r]
-        # Samples: list of patient volumes [slices, w, h]
+        # Shape of the anomaly polygons
+        self.poly_type = "cubic"
+        self.n_vertices = 10
+
+        # Spline fitting of the anomaly polygons is expensive, sample their
+        # outlines once. Location and size are still sampled per item
+        order = 1 if self.poly_type == "linear" else 3
+        self.polygon_pool = np.stack([
+            sample_polygon_points(n_vertices=self.n_vertices, order=order)
+            for _ in range(polygon_pool_size)
+        ])
 
         # Number of scans in dataset
-        self.n_scans = len(samples)
+        self.n_scans = len(files)
+        # Number of slices in one viewing direction (scans are resized to
+        # img_size in every dimension)
+        self.sample_depth = img_size
         # Number of slices per scan (3 viewing directions)
-        # self.n_slices = np.array(samples[0].shape).sum()
-        self.n_slices = -1
-        # Number of slices in one viewing direction
-        self.sample_depth = samples[0].shape[0]
+        self.n_slices = 3 * self.sample_depth
 
         self.slices_on_forward = slices_on_forward
         self.mid_slice = slices_on_forward // 2
 
-        self.samples = []
-        for sample in samples:
-            # Add slices from all three viewing directions
-            axial = sample
-            coronal = np.moveaxis(sample, 1, 0)
-            sagittal = np.moveaxis(sample, 2, 0)
-            self.samples += [sl for sl in axial]
-            self.samples += [sl for sl in coronal]
-            self.samples += [sl for sl in sagittal]
-            if self.n_slices == -1:
-                self.n_slices = len(self.samples)
+        # Store all scans as one contiguous array [n_scans, d, d, d], the
+        # slices of all viewing directions are selected as views from it
+        shape = (self.n_scans, img_size, img_size, img_size)
+        if shared_memory:
+            self.samples = self.load_files_to_shared_memory(
+                files, img_size, shape=shape, dtype=np.float16)
+        else:
+            self.samples = self.load_files_to_array(
+                files, img_size, shape=shape, dtype=np.float16)
         self.data = data
 
+        # Pool of pre-sampled scan indices for the patch exchange
+        self.rng = None
+        self.rng_seed = None
+        self.other_scan_pool = np.empty(0, dtype=np.int64)
+        self.pool_pos = 0
+
     def __len__(self):
-        return len(self.samples)
+        return self.n_scans * self.n_slices
 
     @staticmethod
-    def load_batch(files, img_size):
-        samples = []
-        for f in files:
-            # Samples are shape [width, height, slices]
-            samples.append(process_scan(f, img_size, equalize_hist=False))
-            if np.any(np.isnan(samples[-1])):
-                print(f)
+    def load_file(f, img_size):
+        # Samples are shape [width, height, slices]
+        sample = process_scan(f, img_size, equalize_hist=False)
+        if np.any(np.isnan(sample)):
+            print(f)
+
+        # Intensities are in [0, 1], float16 needs half the memory of float32
+        return sample.astype(np.float16)
 
-        return samples
+    @staticmethod
+    def load_file_to_shared_memory(idx, f, img_size, shm_name, shape, dtype):
+        sample = PatchSwapDataset.load_file(f, img_size)
+
+        # Attach to the shared array
+        shm = SharedMemory(name=shm_name)
+        samples = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        samples[idx] = sample
+
+        # Release the view before detaching
+        del samples
+        shm.close()
+
+    def __getstate__(self):
+        # Spawned processes re-attach to the shared memory by name instead
+        # of receiving a pickled copy of all slices
+        state = self.__dict__.copy()
+        if self.shm is not None:
+            del state["samples"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shm is not None:
+            self.samples = self.shared_array()
+
+    def __del__(self):
+        # Drop the view before the shared memory is closed
+        self.samples = None
+        super().__del__()
+
+    def get_slices(self, scan, i_slice):
+        """Return the slices_on_forward slices around slice i_slice of a
+        scan. i_slice indexes the slices of all three viewing directions
+        (axial, coronal, sagittal)"""
+        direction, i = divmod(i_slice, self.sample_depth)
+        lo = self.slices_on_forward // 2
+        hi = self.slices_on_forward // 2 + 1
+        # Select the slices as a view in the viewing direction and only copy
+        # those
+        volume = np.moveaxis(self.samples[scan], direction, 0)
+        return np.ascontiguousarray(volume[i - lo:i + hi])
+
+    def sample_other_scan(self, pool_size=4096):
+        """Return a random scan index. Indices are drawn in vectorized
+        batches of pool_size instead of one Python RNG call per item"""
+        # torch seeds every DataLoader worker differently, create a new
+        # generator whenever we are in a new worker (or epoch)
+        seed = torch.initial_seed()
+        if self.rng_seed != seed:
+            self.rng = np.random.default_rng(seed)
+            self.rng_seed = seed
+            self.pool_pos = len(self.other_scan_pool)
+
+        # Refill the pool if it is used up
+        if self.pool_pos >= len(self.other_scan_pool):
+            self.other_scan_pool = self.rng.integers(
+                0, self.n_scans, size=pool_size)
+            self.pool_pos = 0
+
+        other_scan = self.other_scan_pool[self.pool_pos]
+        self.pool_pos += 1
+        return other_scan
 
     def create_anomaly(self, img1, img2):
         """Create a sample where one patch is switched from another sample
@@ -170,7 +325,8 @@ class PatchSwapDataset(PreloadDataset):
         mask = sample_complete_mask(
             n_patches=self.num_anomalies, blur_prob=0., img=img1,
             size_range=size_range, data=self.data, patch_type="polygon",
-            poly_type="cubic", n_vertices=10
+            poly_type=self.poly_type, n_vertices=self.n_vertices,
+            polygon_pool=self.polygon_pool
         )
 
         # Swap patches between img1 and img2 at mask
@@ -193,17 +349,16 @@ class PatchSwapDataset(PreloadDataset):
                 idx -= 1  # Upper border, select prev idx
 
         # Select sample
-        lo = self.slices_on_forward // 2
-        hi = self.slices_on_forward // 2 + 1
-        sample = np.stack(self.samples[idx - lo:idx + hi]).copy()
+        scan = idx // self.n_slices
+        i_slice = idx % self.n_slices
+        sample = self.get_slices(scan, i_slice)
 
         # Randomly select another sample at the same slice
-        i_slice = idx % self.n_slices
-        other_scan = random.randint(0, self.n_scans - 1)
-        other_idx = other_scan * self.n_slices + i_slice
-        other_sample = np.stack(self.samples[other_idx - lo:other_idx + hi])
+        other_scan = self.sample_other_scan()
+        other_sample = self.get_slices(other_scan, i_slice)
 
-        # Create foreign patch interpolation
+        # Create foreign patch interpolation, the float16 slices are promoted
+        # to float32 by the float32 mask
         sample, patch = self.create_anomaly(sample, other_sample)
 
         return sample, patch